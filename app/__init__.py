@@ -1,32 +1,76 @@
-import logging
-from logging.handlers import RotatingFileHandler
-import os
+from time import perf_counter
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from config import Config
 from flask_moment import Moment
+from app import logs
+from app.cache import IdentityCache
+from app.profiler import Profiler
+from app.ratelimit import RateLimiter
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
-login.login_view = 'login'
-moment = Moment(app)
-
-if not app.debug:
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/travel_diary.log', maxBytes=10240,
-                                       backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Travel diary startup')
-
-from app import routes, models, errors
+db = SQLAlchemy()
+migrate = Migrate()
+login = LoginManager()
+login.login_view = 'main.login'
+moment = Moment()
+user_cache = IdentityCache()
+limiter = RateLimiter()
+profiler = Profiler()
+
+
+def include_name(name, type_, parent_names):
+    """
+    Autogenerate filter: the R-tree index of post places
+    and its shadow tables are created by hand
+    """
+    return not (type_ == 'table' and name.startswith('post_place_rtree'))
+
+
+def create_app(config_class=Config, web=True):
+    """
+    Application factory.
+    Blueprints are imported only here, so the bot and scripts
+    that need just the models don't pay for the web part
+    :param config_class: config object
+    :param web: register the pages and error handlers
+    :return: Flask app
+    """
+    started = perf_counter()
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    db.init_app(app)
+    migrate.init_app(app, db, include_name=include_name)
+    login.init_app(app)
+    moment.init_app(app)
+    user_cache.init_app(app)
+    limiter.init_app(app)
+    # before the blueprints, so their request hooks are profiled too
+    profiler.init_app(app)
+
+    from app import models  # noqa: F401, the tables must be known to db
+    if web:
+        from app.errors import bp as errors_bp
+        app.register_blueprint(errors_bp)
+
+        from app.routes import bp as main_bp
+        app.register_blueprint(main_bp)
+
+        from app.trending import refresher
+        refresher.init_app(app)
+        from app.photos import hasher
+        hasher.init_app(app)
+        from app.export import exporter
+        exporter.init_app(app)
+
+    from app.cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
+
+    if not app.debug and not app.testing:
+        logs.init_app(app)
+        app.logger.info('Travel diary startup')
+
+    # Reported by "flask serve" to keep track of the startup cost
+    app.extensions['startup_time'] = perf_counter() - started
+    return app
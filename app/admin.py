@@ -0,0 +1,24 @@
+import hmac
+from functools import wraps
+from flask import abort, current_app, request
+
+
+def is_admin_request():
+    """
+    The function of checking the X-Admin-Token header
+    against ADMIN_TOKEN, admin access is off while it is not set
+    :return: boolean
+    """
+    token = current_app.config.get('ADMIN_TOKEN')
+    header = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(header, token)
+
+
+def admin_required(view):
+    """View decorator for the service pages"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
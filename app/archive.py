@@ -0,0 +1,158 @@
+import threading
+from datetime import datetime, timedelta
+from math import ceil
+import sqlalchemy as sa
+from flask import abort
+from app import db, geo
+from app.models import Post, PostScore, PhotoHash, ArchivedPost
+
+# Hot tables holding rows of a post that must go together with it
+DEPENDENT_TABLES = (PostScore.__table__, PhotoHash.__table__)
+
+_archive_ready = False
+_archive_lock = threading.Lock()
+
+
+def ensure_archive():
+    """
+    The function of creating the archive tables once per process.
+    The background threads page the archive too, so the check is locked
+    """
+    global _archive_ready
+    with _archive_lock:
+        if _archive_ready:
+            return
+        try:
+            db.create_all(bind_key='archive')
+        except sa.exc.OperationalError:
+            # another process created the tables between the check and CREATE
+            db.create_all(bind_key='archive')
+        _archive_ready = True
+
+
+def count(select):
+    """
+    The function of counting the rows of a select
+    :param select: Select
+    :return: int
+    """
+    return db.session.scalar(sa.select(sa.func.count())
+                             .select_from(select.order_by(None).subquery()))
+
+
+class ArchivePagination(object):
+    """
+    Pagination of the hot posts that continues into the archive,
+    with the attributes of the Flask-SQLAlchemy pagination used by the views.
+    Archived posts are older than any hot post, so the archive
+    is queried only by the pages that reach the end of the hot set.
+    Until then total counts the hot posts only
+    """
+
+    def __init__(self, select, archive, page=1, per_page=20, error_out=True):
+        if page < 1 or per_page < 1:
+            if error_out:
+                abort(404)
+            page, per_page = max(page, 1), max(per_page, 1)
+        self.page = page
+        self.per_page = per_page
+        offset = (page - 1) * per_page
+        hot_total = count(select)
+        items = db.session.scalars(select.limit(per_page).offset(offset)).all() \
+            if offset < hot_total else []
+        archive_total = 0
+        if offset + per_page >= hot_total:
+            ensure_archive()
+            archive_total = count(archive)
+            need = per_page - len(items)
+            if need > 0:
+                items += db.session.scalars(
+                    archive.limit(need)
+                    .offset(max(0, offset - hot_total))).all()
+        if error_out and page > 1 and not items:
+            abort(404)
+        self.items = items
+        self.total = hot_total + archive_total
+
+    @property
+    def pages(self):
+        return ceil(self.total / self.per_page)
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+def paginate(select, archive, **kwargs):
+    """
+    The function of paginating posts with the archive continuation
+    :param select: select of Post
+    :param archive: the same select of ArchivedPost
+    :param kwargs: page, per_page, error_out as in db.paginate
+    :return: ArchivePagination
+    """
+    return ArchivePagination(select, archive, **kwargs)
+
+
+def archive_posts(days, batch_size=500):
+    """
+    The function of moving posts older than the given age to the archive.
+    Every batch is committed to the archive before it is deleted
+    from the hot table, a rerun after a failure replaces the copies.
+    A different archived post with the same ID is never replaced,
+    the insert fails instead
+    :param days: age of the posts in days
+    :return: number of archived posts
+    """
+    ensure_archive()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    post_table = Post.__table__
+    archive_table = ArchivedPost.__table__
+    count = 0
+    while True:
+        rows = db.session.execute(
+            sa.select(post_table).where(post_table.c.timestamp < cutoff)
+            .order_by(post_table.c.id).limit(batch_size)).mappings().all()
+        if not rows:
+            break
+        ids = [row['id'] for row in rows]
+        # only the copies of the same posts, left by a failed run
+        db.session.execute(sa.delete(archive_table).where(
+            sa.tuple_(archive_table.c.id, archive_table.c.user_id,
+                      archive_table.c.timestamp).in_(
+                [(row['id'], row['user_id'], row['timestamp'])
+                 for row in rows])))
+        db.session.execute(sa.insert(archive_table),
+                           [{column.key: row[column.key]
+                             for column in archive_table.columns}
+                            for row in rows])
+        db.session.commit()
+
+        geo.unindex_posts(ids)
+        for table in DEPENDENT_TABLES:
+            db.session.execute(
+                sa.delete(table).where(table.c.post_id.in_(ids)))
+        db.session.execute(sa.delete(post_table).where(post_table.c.id.in_(ids)))
+        db.session.commit()
+        count += len(ids)
+    return count
+
+
+def vacuum():
+    """The function of shrinking the hot SQLite database after archiving"""
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class IdentityCache(object):
+    """
+    Per-process cache of model rows with bounded size and TTL.
+    Stores plain column snapshots keyed by primary key,
+    plus an index of an alternative unique key (username)
+    """
+
+    def __init__(self, app=None, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._rows = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of reading the cache settings from the config
+        :param app: Flask app
+        """
+        self.maxsize = app.config.get('IDENTITY_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, id):
+        """
+        The function of getting a snapshot by primary key
+        :param id: primary key
+        :return: dict or None if missing or expired
+        """
+        with self._lock:
+            entry = self._rows.get(id)
+            if entry is None:
+                return None
+            snapshot, key, expires = entry
+            if expires < monotonic():
+                self._drop(id)
+                return None
+            self._rows.move_to_end(id)
+            return snapshot
+
+    def get_by_key(self, key):
+        """
+        The function of getting a snapshot by the alternative key
+        :param key: unique key (username)
+        :return: dict or None
+        """
+        id = self._keys.get(key)
+        return None if id is None else self.get(id)
+
+    def set(self, id, key, snapshot):
+        """
+        The function of saving a snapshot, the oldest entries
+        are evicted when the cache is full
+        :param id: primary key
+        :param key: unique key (username)
+        :param snapshot: dict of column values
+        """
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._drop(id)
+            self._rows[id] = (snapshot, key, monotonic() + self.ttl)
+            self._keys[key] = id
+            while len(self._rows) > self.maxsize:
+                self._drop(next(iter(self._rows)))
+
+    def invalidate(self, id):
+        """
+        The function of removing a row after it has been changed
+        :param id: primary key
+        """
+        with self._lock:
+            self._drop(id)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._keys.clear()
+
+    def _drop(self, id):
+        entry = self._rows.pop(id, None)
+        if entry is not None and self._keys.get(entry[1]) == id:
+            del self._keys[entry[1]]
@@ -0,0 +1,107 @@
+import click
+from flask import Blueprint, current_app
+from app import server, archive, geo
+from app.export import exporter
+from app.photos import hasher
+from app.trending import refresher
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+
+@bp.cli.command('serve')
+@click.option('--bind', '-b', default=None, help='host:port to listen on.')
+@click.option('--workers', '-w', default=None, type=int,
+              help='Number of worker processes.')
+def serve(bind, workers):
+    """
+    Production server: preloads the app and forks the workers.
+    kill -HUP <master pid> reloads the code gracefully
+    """
+    app = current_app._get_current_object()
+    click.echo('App loaded in {:.0f} ms'.format(
+        app.extensions['startup_time'] * 1000))
+    server.serve(app,
+                 bind or app.config['SERVER_BIND'],
+                 workers or app.config['SERVER_WORKERS'],
+                 app.config['SERVER_GRACEFUL_TIMEOUT'])
+
+
+@bp.cli.group()
+def trending():
+    """Trending scores commands."""
+    pass
+
+
+@trending.command()
+def refresh():
+    """Rescore new posts and posts with changed engagement."""
+    click.echo('Rescored {} posts'.format(refresher.refresh()))
+
+
+@trending.command()
+def rebuild():
+    """Recompute the scores of all posts."""
+    click.echo('Rescored {} posts'.format(refresher.rebuild()))
+
+
+@bp.cli.group('archive')
+def archive_group():
+    """Archive of old posts commands."""
+    pass
+
+
+@archive_group.command('run')
+@click.option('--days', '-d', default=None, type=int,
+              help='Archive posts older than this many days.')
+@click.option('--vacuum', is_flag=True,
+              help='Shrink the SQLite database afterwards.')
+def archive_run(days, vacuum):
+    """Move old posts from the hot table to the archive."""
+    days = days or current_app.config['ARCHIVE_AFTER_DAYS']
+    click.echo('Archived {} posts'.format(archive.archive_posts(days)))
+    if vacuum:
+        archive.vacuum()
+
+
+@bp.cli.group('geo')
+def geo_group():
+    """Places of posts commands."""
+    pass
+
+
+@geo_group.command('backfill')
+def geo_backfill():
+    """Geocode all posts again with the bundled gazetteer."""
+    click.echo('Geocoded {} posts'.format(geo.backfill()))
+
+
+@bp.cli.group()
+def photos():
+    """Uploaded photos commands."""
+    pass
+
+
+@photos.command('hash')
+def photos_hash():
+    """Hash the new photos and link the near-duplicates."""
+    count = 0
+    while True:
+        done = hasher.run_once()
+        count += done
+        if done < hasher.batch_size:
+            break
+    click.echo('Hashed {} photos'.format(count))
+
+
+@bp.cli.group('export')
+def export_group():
+    """Static export of the diaries commands."""
+    pass
+
+
+@export_group.command('run')
+@click.option('--all', 'everything', is_flag=True,
+              help='Export all diaries, not only the changed ones.')
+def export_run(everything):
+    """Render the changed diaries into EXPORT_DIR."""
+    click.echo('Exported {} diaries'.format(exporter.run_once(everything)))
@@ -1,8 +1,10 @@
-from flask import render_template
-from app import app, db
+from flask import Blueprint, render_template
+from app import db
 
+bp = Blueprint('errors', __name__)
 
-@app.errorhandler(404)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     """
     Handler for the missing page error
@@ -12,7 +14,28 @@ def not_found_error(error):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(413)
+def too_large_error(error):
+    """
+    Handler for the uploads larger than MAX_CONTENT_LENGTH
+    :param error: code
+    :return: render page
+    """
+    return render_template('413.html'), 413
+
+
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    """
+    Handler for the rate limited requests
+    :param error: TooManyRequests with retry_after
+    :return: render page with the Retry-After header
+    """
+    return render_template('429.html', retry_after=error.retry_after), 429, \
+        {'Retry-After': str(error.retry_after)}
+
+
+@bp.app_errorhandler(500)
 def internal_error(error):
     """
     Server-side error handler
@@ -0,0 +1,249 @@
+import json
+import os
+import re
+import shutil
+import threading
+from urllib.parse import quote
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from flask import current_app, render_template
+from app import db, archive
+from app.models import User, Post, ArchivedPost, DiaryExport, insert_or_ignore
+
+PAGE_FILE = re.compile(r'page-(\d+)\.(html|json)$')
+
+
+def diary_directory(username):
+    """
+    The function of the export directory of a diary.
+    The name is percent-encoded, so any username gets a directory
+    and '/' cannot lead out of EXPORT_DIR
+    :param username: str
+    :return: EXPORT_DIR/<encoded username> or None for '.' and '..'
+    """
+    name = quote(username, safe='')
+    if name in ('', '.', '..'):
+        return None
+    return os.path.join(current_app.config['EXPORT_DIR'], name)
+
+
+def page_name(page, extension):
+    """
+    The function of the file name of a diary page
+    :param page: page number
+    :param extension: 'html' or 'json'
+    :return: str
+    """
+    if page == 1:
+        return 'index.html' if extension == 'html' else 'page-1.json'
+    return 'page-{}.{}'.format(page, extension)
+
+
+def write_file(path, text):
+    """
+    The function of replacing a file atomically,
+    the static server never reads a half-written page
+    """
+    # unique per thread, "flask export run" may race with the background pass
+    temp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temp, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(temp, path)
+
+
+def post_data(post):
+    """Post fields of the JSON export, Post or ArchivedPost"""
+    return {
+        'id': post.id,
+        'head': post.head,
+        'body': post.body,
+        'timestamp': post.timestamp.replace(tzinfo=timezone.utc).isoformat(),
+        'price': post.price,
+        'places': post.places,
+        'photo_url': post.photo_url or None,
+        'video_url': post.video_url or None,
+    }
+
+
+class DiaryExporter(object):
+    """
+    Static export of the diaries: every profile with its posts,
+    the archived ones included, is rendered into HTML and JSON files
+    under EXPORT_DIR/<username>/ that any static server or CDN can serve.
+    The changes only mark the diary in the diary_export table
+    in their own transaction, a thread in every process re-renders
+    the marked diaries
+    """
+
+    def __init__(self, app=None, batch_size=50):
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        # the thread is woken only when the marks are committed
+        sa.event.listen(db.session, 'after_commit', self._after_commit)
+        sa.event.listen(db.session, 'after_rollback', self._after_rollback)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of starting the exporter with the first request
+        :param app: Flask app
+        """
+        if app.config.get('EXPORT_INTERVAL'):
+            app.before_request(self._start)
+
+    def mark(self, user_ids):
+        """
+        The function of marking diaries as changed in the transaction
+        of the change, the exporter is woken up after its commit
+        :param user_ids: iterable of user IDs
+        """
+        db.session.execute(
+            sa.update(DiaryExport)
+            .where(DiaryExport.user_id.in_(list(user_ids)))
+            .values(version=DiaryExport.version + 1))
+        db.session.info['export_marked'] = True
+
+    def run_once(self, everything=False):
+        """
+        The function of exporting the changed diaries
+        :param everything: export all diaries
+        :return: number of exported diaries
+        """
+        started = datetime.now(timezone.utc)
+        query = sa.select(User).outerjoin(DiaryExport).order_by(User.id) \
+            .limit(self.batch_size)
+        if not everything:
+            query = query.where(sa.or_(
+                DiaryExport.user_id.is_(None),
+                DiaryExport.exported_version.is_(None),
+                DiaryExport.version > DiaryExport.exported_version))
+        count = 0
+        last_id = 0
+        while True:
+            users = db.session.scalars(query.where(User.id > last_id)).all()
+            for user in users:
+                self.export_user(user, started)
+                db.session.commit()
+            count += len(users)
+            if len(users) < self.batch_size:
+                return count
+            last_id = users[-1].id
+
+    def export_user(self, user, started):
+        """
+        The function of rendering one diary
+        :param user: User
+        :param started: time of the export pass
+        """
+        state = db.session.get(DiaryExport, user.id)
+        if state is None:
+            # mark() only updates the row, it must exist before the render
+            db.session.execute(insert_or_ignore(DiaryExport.__table__)
+                               .values(user_id=user.id, username=user.username))
+            db.session.commit()
+            state = db.session.get(DiaryExport, user.id)
+        # the files are made of this version or a later one,
+        # changes marked after this read increment it again
+        version = state.version
+        if state.username != user.username:
+            old = diary_directory(state.username)
+            if old:
+                shutil.rmtree(old, ignore_errors=True)
+        directory = diary_directory(user.username)
+        if directory is None:
+            current_app.logger.warning('Cannot export diary of %s', user.username)
+        else:
+            self.render(user, directory)
+
+        db.session.execute(
+            sa.update(DiaryExport).where(DiaryExport.user_id == user.id)
+            .values(username=user.username, exported_version=version,
+                    exported_at=started))
+
+    def render(self, user, directory):
+        """
+        The function of writing the pages and the profile of a diary
+        :param user: User
+        :param directory: EXPORT_DIR/<username>
+        """
+        config = current_app.config
+        os.makedirs(directory, exist_ok=True)
+        query = user.posts.select().order_by(Post.timestamp.desc())
+        archived = sa.select(ArchivedPost) \
+            .where(ArchivedPost.user_id == user.id) \
+            .order_by(ArchivedPost.timestamp.desc())
+        profile = {
+            'username': user.username,
+            'about_me': user.about_me,
+            'telegram': user.telegram,
+            'avatar': user.avatar(128),
+            'followers': user.followers_count(),
+            'following': user.following_count(),
+        }
+        page = 1
+        while True:
+            posts = archive.paginate(query, archived, page=page,
+                                     per_page=config['EXPORT_POSTS_PER_PAGE'],
+                                     error_out=False)
+            write_file(os.path.join(directory, page_name(page, 'html')),
+                       render_template(
+                           'export/user.html', title=user.username,
+                           profile=profile, posts=posts.items,
+                           media_url=config['EXPORT_MEDIA_URL'],
+                           prev_url=page_name(page - 1, 'html')
+                           if posts.has_prev else None,
+                           next_url=page_name(page + 1, 'html')
+                           if posts.has_next else None))
+            write_file(os.path.join(directory, page_name(page, 'json')),
+                       json.dumps({'page': page,
+                                   'posts': [post_data(post)
+                                             for post in posts.items]},
+                                  ensure_ascii=False))
+            if not posts.has_next:
+                break
+            page += 1
+
+        # the total includes the archive only on the last page
+        pages = page
+        profile.update(posts=posts.total, pages=pages)
+        write_file(os.path.join(directory, 'profile.json'),
+                   json.dumps(profile, ensure_ascii=False))
+        # the diary could have had more pages before
+        for name in os.listdir(directory):
+            match = PAGE_FILE.match(name)
+            if match and int(match.group(1)) > pages:
+                os.remove(os.path.join(directory, name))
+
+    def _after_commit(self, session):
+        if session.info.pop('export_marked', False):
+            self._wake.set()
+
+    def _after_rollback(self, session):
+        session.info.pop('export_marked', None)
+
+    def _start(self):
+        # the thread is started after fork, in the process that serves requests
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run, args=(app,), daemon=True,
+                         name='diary-exporter').start()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(app.config['EXPORT_INTERVAL'])
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self.run_once()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Diary export failed')
+
+
+exporter = DiaryExporter()
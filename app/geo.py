@@ -0,0 +1,147 @@
+import csv
+import math
+import os
+import sqlalchemy as sa
+from app import db
+from app.models import Post, PostPlace
+from app.pricing import split_places
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), 'data', 'gazetteer.csv')
+KM_PER_DEGREE = 111.32
+
+post_place_rtree = sa.table('post_place_rtree',
+                            sa.column('id', sa.Integer),
+                            sa.column('min_lat', sa.Float),
+                            sa.column('max_lat', sa.Float),
+                            sa.column('min_lon', sa.Float),
+                            sa.column('max_lon', sa.Float))
+
+_gazetteer = None
+
+
+def gazetteer():
+    """
+    The function of loading the bundled gazetteer once per process
+    :return: dict name -> (lat, lon)
+    """
+    global _gazetteer
+    if _gazetteer is None:
+        places = {}
+        with open(GAZETTEER_PATH, encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                for name in row['names'].split('|'):
+                    places[name] = (float(row['lat']), float(row['lon']))
+        _gazetteer = places
+    return _gazetteer
+
+
+def geocode(name):
+    """
+    The function of finding the coordinates of a place, no network calls
+    :param name: place name in any case
+    :return: (lat, lon) or None
+    """
+    return gazetteer().get(name.strip().lower())
+
+
+def post_places(post):
+    """
+    The function of geocoding the title and the places of a post
+    :param post: Post
+    :return: dict name -> (lat, lon)
+    """
+    found = {}
+    for name in split_places(post.head) + split_places(post.places):
+        point = geocode(name)
+        if point is not None:
+            found[name] = point
+    return found
+
+
+def _use_rtree():
+    return db.session.get_bind().dialect.name == 'sqlite'
+
+
+def index_post(post):
+    """
+    The function of saving the places of a new post with the spatial index.
+    Runs in the transaction of the post, flushes it to get the ID
+    :param post: Post
+    """
+    found = post_places(post)
+    if not found:
+        return
+    db.session.flush()
+    places = [PostPlace(post_id=post.id, name=name[:100], lat=lat, lon=lon)
+              for name, (lat, lon) in found.items()]
+    db.session.add_all(places)
+    db.session.flush()
+    if _use_rtree():
+        db.session.execute(sa.insert(post_place_rtree), [
+            {'id': place.id, 'min_lat': place.lat, 'max_lat': place.lat,
+             'min_lon': place.lon, 'max_lon': place.lon} for place in places])
+
+
+def unindex_posts(ids):
+    """
+    The function of removing the places of posts
+    :param ids: list of post IDs
+    """
+    if _use_rtree():
+        db.session.execute(sa.delete(post_place_rtree).where(
+            post_place_rtree.c.id.in_(
+                sa.select(PostPlace.id).where(PostPlace.post_id.in_(ids)))))
+    db.session.execute(sa.delete(PostPlace).where(PostPlace.post_id.in_(ids)))
+
+
+def backfill(batch_size=500):
+    """
+    The function of geocoding all posts again,
+    e.g. after the gazetteer has been extended
+    :return: number of posts with places
+    """
+    count = 0
+    last_id = 0
+    while True:
+        posts = db.session.scalars(
+            sa.select(Post).where(Post.id > last_id)
+            .order_by(Post.id).limit(batch_size)).all()
+        if not posts:
+            break
+        unindex_posts([post.id for post in posts])
+        for post in posts:
+            index_post(post)
+            count += bool(post_places(post))
+        db.session.commit()
+        last_id = posts[-1].id
+    return count
+
+
+def nearby(lat, lon, radius_km):
+    """
+    The function of the select of posts near a point.
+    The R-tree gives the places inside the bounding box,
+    the equirectangular distance cuts its corners off
+    :param lat: latitude
+    :param lon: longitude
+    :param radius_km: radius
+    :return: select of Post, newest first
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(lat)), 0.01)
+    dlon = min(radius_km / (KM_PER_DEGREE * cos_lat), 180)
+    distance = (PostPlace.lat - lat) * (PostPlace.lat - lat) + \
+        (PostPlace.lon - lon) * (PostPlace.lon - lon) * cos_lat * cos_lat
+    places = sa.select(PostPlace.post_id).where(distance <= dlat * dlat)
+    if _use_rtree():
+        places = places.join(post_place_rtree,
+                             post_place_rtree.c.id == PostPlace.id).where(
+            post_place_rtree.c.min_lat >= lat - dlat,
+            post_place_rtree.c.max_lat <= lat + dlat,
+            post_place_rtree.c.min_lon >= lon - dlon,
+            post_place_rtree.c.max_lon <= lon + dlon)
+    else:
+        places = places.where(PostPlace.lat.between(lat - dlat, lat + dlat),
+                              PostPlace.lon.between(lon - dlon, lon + dlon))
+    return sa.select(Post).where(Post.id.in_(places)) \
+        .order_by(Post.timestamp.desc())
@@ -0,0 +1,181 @@
+import atexit
+import copy
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Attributes every LogRecord has, the others came from extra={...}
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | \
+    {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+        }
+        for key, value in vars(record).items():
+            if key == 'extra' and isinstance(value, dict):
+                # loguru keeps bind()/extra fields in one dict
+                entry.update(value)
+            elif key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SizeTimedRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotation by size or by age of the file, whichever comes first.
+    Several processes may write the same file: the rollover
+    is done under a file lock, and a process notices that
+    the file was rotated by another one and reopens it
+    """
+
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes,
+                         backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self._opened()
+
+    def _opened(self):
+        stat = os.stat(self.baseFilename)
+        self._inode = stat.st_ino
+        self.rollover_at = stat.st_mtime + self.interval
+
+    def shouldRollover(self, record):
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self._inode:
+            self.stream.close()
+            self.stream = self._open()
+            self._opened()
+            return False
+        return stat.st_size >= self.maxBytes or time.time() >= self.rollover_at
+
+    def doRollover(self):
+        with open(self.baseFilename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process could have rotated the file while we waited
+            if os.stat(self.baseFilename).st_ino == self._inode:
+                super().doRollover()
+            else:
+                self.stream.close()
+                self.stream = self._open()
+        self._opened()
+
+
+class DebugSampler(logging.Filter):
+    """Passes only a share of the DEBUG records, all the others pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Puts records in a bounded queue for the writer thread.
+    The caller never waits for the disk, if the writer falls behind
+    the records are dropped and counted
+    """
+
+    def __init__(self, size):
+        super().__init__(queue.Queue(size))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatted now, the writer thread must not touch the caller's objects
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# filename -> (queue handler, listener)
+_pipelines = {}
+
+
+def get_handler(config, filename):
+    """
+    The function of getting the non-blocking handler of a log file.
+    One background writer per file and process
+    :param config: app config
+    :param filename: file name in LOG_DIR
+    :return: logging.Handler
+    """
+    if filename in _pipelines:
+        return _pipelines[filename][0]
+    os.makedirs(config['LOG_DIR'], exist_ok=True)
+    file_handler = SizeTimedRotatingFileHandler(
+        os.path.join(config['LOG_DIR'], filename), config['LOG_MAX_BYTES'],
+        config['LOG_ROTATE_SECONDS'], config['LOG_BACKUP_COUNT'])
+    file_handler.setFormatter(JsonFormatter())
+    handler = NonBlockingQueueHandler(config['LOG_QUEUE_SIZE'])
+    handler.addFilter(DebugSampler(config['LOG_DEBUG_SAMPLE_RATE']))
+    listener = QueueListener(handler.queue, file_handler)
+    listener.start()
+    _pipelines[filename] = (handler, listener)
+    return handler
+
+
+def init_app(app, filename='travel_diary.log'):
+    """
+    The function of sending the app log to the pipeline
+    :param app: Flask app
+    :param filename: file name in LOG_DIR
+    """
+    app.logger.addHandler(get_handler(app.config, filename))
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+
+
+def stop():
+    """The function of writing out the queued records, called at exit"""
+    for handler, listener in _pipelines.values():
+        if listener._thread is not None:
+            handler.queue.put(listener._sentinel)
+            listener._thread.join()
+            listener._thread = None
+
+
+def _restart_in_child():
+    # the writer threads are not copied by fork, every process needs its own
+    for handler, listener in _pipelines.values():
+        handler.queue = queue.Queue(handler.queue.maxsize)
+        listener.queue = handler.queue
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(stop)
+os.register_at_fork(after_in_child=_restart_in_child)
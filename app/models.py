@@ -3,12 +3,14 @@ from hashlib import md5
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from app import db, login
+from app import db, login, user_cache
 from time import time
 import jwt
-from app import app
+from flask import current_app
+from app.pricing import parse_price
 
 # The structure in the form of a visual model in "../migrations/db_struct"
 # The image corresponds to the migration version by name
@@ -24,6 +26,20 @@ followers = sa.Table(
 )
 
 
+def insert_or_ignore(table):
+    """
+    INSERT that skips the rows already present in the table
+    :param table: Table
+    :return: Insert
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return sa.insert(table).prefix_with('IGNORE')
+
+
 class User(UserMixin, db.Model):
     """User model"""
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -62,6 +78,8 @@ class User(UserMixin, db.Model):
         :param password: user password
         """
         self.password_hash = generate_password_hash(password)
+        if self.id is not None:
+            user_cache.invalidate(self.id)
 
     def check_password(self, password):
         """
@@ -82,19 +100,95 @@ class User(UserMixin, db.Model):
         return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
     def follow(self, user):
-        """Subscription function"""
-        if not self.is_following(user):
-            self.following.add(user)
+        """
+        Subscription function
+        :return: boolean, False if already subscribed
+        """
+        return bool(self.follow_ids([user.id]))
 
     def unfollow(self, user):
-        """Unsubscribe function"""
-        if self.is_following(user):
-            self.following.remove(user)
+        """
+        Unsubscribe function
+        :return: boolean, False if was not subscribed
+        """
+        return bool(self.unfollow_ids([user.id]))
+
+    def follow_ids(self, ids):
+        """
+        Bulk subscription function.
+        One idempotent statement, existing subscriptions are skipped
+        by the database, so double clicks don't hit the primary key
+        :param ids: IDs of the users
+        :return: list of IDs of the new subscriptions
+        """
+        ids = {id for id in ids if id != self.id}
+        if not ids:
+            return []
+        if db.session.get_bind().dialect.insert_returning:
+            query = insert_or_ignore(followers).values(
+                [{'follower_id': self.id, 'followed_id': id} for id in ids])
+            return list(db.session.scalars(
+                query.returning(followers.c.followed_id)))
+        # without RETURNING the new pairs are found first,
+        # the locked rows cannot change until the insert
+        ids = set(db.session.scalars(
+            sa.select(User.id).where(User.id.in_(ids)))) - \
+            self._locked_following(ids)
+        if ids:
+            db.session.execute(insert_or_ignore(followers).values(
+                [{'follower_id': self.id, 'followed_id': id} for id in ids]))
+        return list(ids)
+
+    def unfollow_ids(self, ids):
+        """
+        Bulk unsubscribe function, one DELETE ... RETURNING
+        :param ids: IDs of the users
+        :return: list of IDs of the removed subscriptions
+        """
+        ids = set(ids)
+        if not ids:
+            return []
+        query = sa.delete(followers).where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_(ids))
+        if db.session.get_bind().dialect.delete_returning:
+            return list(db.session.scalars(
+                query.returning(followers.c.followed_id)))
+        ids = self._locked_following(ids)
+        if ids:
+            db.session.execute(query)
+        return list(ids)
+
+    def _locked_following(self, ids):
+        """
+        The function of reading the subscriptions to the given users
+        with a lock until the end of the transaction
+        :param ids: IDs of the users
+        :return: set of IDs
+        """
+        return set(db.session.scalars(
+            sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(ids)).with_for_update()))
 
     def is_following(self, user):
         """Subscription verification function"""
-        query = self.following.select().where(User.id == user.id)
-        return db.session.scalar(query) is not None
+        return user.id in self.following_ids([user])
+
+    def following_ids(self, users):
+        """
+        Batched subscription verification function.
+        Reads only the followers table, in one query for all users
+        :param users: list of users
+        :return: set of ids of the users this user is following
+        """
+        ids = [user.id for user in users]
+        if not ids:
+            return set()
+        query = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_(ids))
+        return set(db.session.scalars(query))
 
     def followers_count(self):
         """Subscriber counting function"""
@@ -124,6 +218,54 @@ class User(UserMixin, db.Model):
             .order_by(Post.timestamp.desc())
         )
 
+    def snapshot(self):
+        """
+        The function of copying the columns for the identity cache.
+        The password hash is not cached, it is loaded on access
+        :return: dict
+        """
+        return {column.key: getattr(self, column.key)
+                for column in User.__table__.columns
+                if column.key != 'password_hash'}
+
+    @staticmethod
+    def cached(id):
+        """
+        The function of getting a user through the identity cache
+        :param id: user ID
+        :return: User or None
+        """
+        snapshot = user_cache.get(id)
+        if snapshot is None:
+            return User._cache(db.session.get(User, id))
+        return User._from_snapshot(snapshot)
+
+    @staticmethod
+    def cached_by_username(username):
+        """
+        The function of getting a user by name through the identity cache
+        :param username: str
+        :return: User or None
+        """
+        snapshot = user_cache.get_by_key(username)
+        if snapshot is None:
+            return User._cache(db.session.scalar(
+                sa.select(User).where(User.username == username)))
+        return User._from_snapshot(snapshot)
+
+    @staticmethod
+    def _cache(user):
+        if user is not None:
+            user_cache.set(user.id, user.username, user.snapshot())
+        return user
+
+    @staticmethod
+    def _from_snapshot(snapshot):
+        # attach a copy to the current session without a SELECT
+        user = User(**snapshot)
+        so.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def get_reset_password_token(self, expires_in=600):
         """
         The function of get a token to reset the password
@@ -131,7 +273,7 @@ class User(UserMixin, db.Model):
         """
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
-            app.config['SECRET_KEY'], algorithm='HS256')
+            current_app.config['SECRET_KEY'], algorithm='HS256')
 
     @staticmethod
     def verify_reset_password_token(token):
@@ -140,7 +282,7 @@ class User(UserMixin, db.Model):
         :return: User if token else None
         """
         try:
-            id = jwt.decode(token, app.config['SECRET_KEY'],
+            id = jwt.decode(token, current_app.config['SECRET_KEY'],
                             algorithms=['HS256'])['reset_password']
         except:
             return
@@ -154,7 +296,7 @@ def load_user(id):
     which can be called to load a user with an ID
     :param id: user ID
     """
-    return db.session.get(User, int(id))
+    return User.cached(int(id))
 
 
 class Post(db.Model):
@@ -167,10 +309,141 @@ class Post(db.Model):
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
                                                index=True)
     price: so.Mapped[str] = so.mapped_column(sa.String(20))
+    # Parsed from price on save, see validate_price
+    price_amount: so.Mapped[Optional[float]] = so.mapped_column(sa.Float)
+    price_currency: so.Mapped[Optional[str]] = so.mapped_column(sa.String(3))
     places: so.Mapped[str] = so.mapped_column(sa.String(300))
     photo_url: so.Mapped[str] = so.mapped_column(sa.String(100), default=None)
     video_url: so.Mapped[str] = so.mapped_column(sa.String(100), default=None)
+    # Impressions in the feeds, flushed in batches by app.trending
+    views: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
     author: so.Mapped[User] = so.relationship(back_populates='posts')
 
+    __table_args__ = (
+        sa.Index('ix_post_price_currency_amount',
+                 'price_currency', 'price_amount'),
+        # SQLite reuses the largest ID after a delete without it,
+        # a new post would take the ID of an archived one
+        {'sqlite_autoincrement': True},
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    @so.validates('price')
+    def validate_price(self, key, price):
+        """
+        The function of filling the numeric price columns
+        every time the price text is set
+        :param price: price as typed by the user
+        :return: price
+        """
+        self.price_amount, self.price_currency = parse_price(price)
+        return price
+
+
+class PostScore(db.Model):
+    """
+    Materialized trending score of a post, maintained by app.trending.
+    The score does not depend on the current time,
+    so it changes only when the engagement of the post changes
+    """
+    __tablename__ = 'post_score'
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id),
+                                               primary_key=True)
+    score: so.Mapped[float] = so.mapped_column(sa.Float, index=True)
+    updated_at: so.Mapped[datetime] = so.mapped_column(
+        default=lambda: datetime.now(timezone.utc))
+
+
+class PostPlace(db.Model):
+    """
+    Geocoded place of a post, see app.geo.
+    On SQLite the coordinates are also kept in the post_place_rtree index
+    """
+    __tablename__ = 'post_place'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id),
+                                               index=True)
+    name: so.Mapped[str] = so.mapped_column(sa.String(100))
+    lat: so.Mapped[float] = so.mapped_column(sa.Float)
+    lon: so.Mapped[float] = so.mapped_column(sa.Float)
+
+
+# R-tree spatial index of post_place: a point is a box of zero size
+sa.event.listen(PostPlace.__table__, 'after_create', sa.DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS post_place_rtree '
+    'USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+).execute_if(dialect='sqlite'))
+sa.event.listen(PostPlace.__table__, 'after_drop', sa.DDL(
+    'DROP TABLE IF EXISTS post_place_rtree').execute_if(dialect='sqlite'))
+
+
+class PhotoHash(db.Model):
+    """
+    Perceptual hash of a post photo, computed by app.photos.
+    hash is the 64-bit dHash stored as a signed integer,
+    None if the file is not an image
+    """
+    __tablename__ = 'photo_hash'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id),
+                                               unique=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
+    hash: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger)
+    # Post whose photo this one repeats, not a foreign key:
+    # the original may be moved to the archive
+    duplicate_of: so.Mapped[Optional[int]] = so.mapped_column()
+
+    __table_args__ = (
+        sa.Index('ix_photo_hash_user_id_id', 'user_id', 'id'),
+    )
+
+
+class DiaryExport(db.Model):
+    """
+    State of the static export of a diary, maintained by app.export.
+    Every change increments version, a diary is exported again
+    until exported_version, the version its files were made of, reaches it.
+    Users without a row have never been exported
+    """
+    __tablename__ = 'diary_export'
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
+                                               primary_key=True)
+    # directory name, the old one is removed after a rename
+    username: so.Mapped[str] = so.mapped_column(sa.String(64))
+    version: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    exported_version: so.Mapped[Optional[int]] = so.mapped_column()
+    exported_at: so.Mapped[Optional[datetime]] = so.mapped_column()
+
+
+class ArchivedPost(db.Model):
+    """
+    Post moved out of the hot table by app.archive.
+    Lives in the separate "archive" database, so the author
+    is joined without a foreign key
+    """
+    __bind_key__ = 'archive'
+    __tablename__ = 'post_archive'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True,
+                                          autoincrement=False)
+    head: so.Mapped[str] = so.mapped_column(sa.String(100))
+    body: so.Mapped[str] = so.mapped_column(sa.String(300))
+    timestamp: so.Mapped[datetime]
+    user_id: so.Mapped[int]
+    price: so.Mapped[str] = so.mapped_column(sa.String(20))
+    price_amount: so.Mapped[Optional[float]] = so.mapped_column(sa.Float)
+    price_currency: so.Mapped[Optional[str]] = so.mapped_column(sa.String(3))
+    places: so.Mapped[str] = so.mapped_column(sa.String(300))
+    photo_url: so.Mapped[str] = so.mapped_column(sa.String(100))
+    video_url: so.Mapped[str] = so.mapped_column(sa.String(100))
+    views: so.Mapped[int] = so.mapped_column(default=0)
+    author: so.Mapped[User] = so.relationship(
+        primaryjoin='foreign(ArchivedPost.user_id) == User.id', viewonly=True)
+
+    __table_args__ = (
+        sa.Index('ix_post_archive_user_timestamp', 'user_id', 'timestamp'),
+    )
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
@@ -0,0 +1,244 @@
+import os
+import threading
+from collections import OrderedDict
+import sqlalchemy as sa
+from flask import current_app
+from PIL import Image
+from app import db
+from app.export import exporter
+from app.models import Post, PhotoHash, insert_or_ignore
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+def dhash(path, size=8):
+    """
+    The function of calculating the difference hash of an image:
+    the picture is shrunk to (size + 1) x size grey pixels and every bit
+    tells whether a pixel is brighter than its right neighbour.
+    Re-encoding and resizing change only a few bits
+    :param path: image file
+    :return: unsigned int of size * size bits
+    """
+    with Image.open(path) as image:
+        # JPEG is decoded straight to a small greyscale picture
+        image.draft('L', ((size + 1) * 4, size * 4))
+        pixels = list(image.convert('L')
+                      .resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            value = value << 1 | (left > pixels[row * (size + 1) + col + 1])
+    return value
+
+
+def to_signed(value):
+    """64-bit hash as the signed integer of a BIGINT column"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a, b):
+    """Hamming distance of two hashes"""
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of hashes by Hamming distance.
+    A search for the hashes within d of h visits only the children
+    whose edge distance lies in [distance - d, distance + d]
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        """
+        The function of adding a hash
+        :param value: hash
+        :param item: value returned by the search, e.g. post ID
+        """
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d not in node[2]:
+                node[2][d] = (value, item, {})
+                return
+            node = node[2][d]
+
+    def search(self, value, max_distance):
+        """
+        The function of finding the hashes close to the given one
+        :return: list of (distance, item), nearest first
+        """
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, item, children = stack.pop()
+            d = distance(value, node_value)
+            if d <= max_distance:
+                found.append((d, item))
+            for edge, child in children.items():
+                if d - max_distance <= edge <= d + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+class PhotoHasher(object):
+    """
+    Background near-duplicate detection of the uploaded photos.
+    Publishing only wakes the thread up, it hashes the photos
+    of the posts that have no photo_hash row yet, compares them
+    with the earlier photos of the author and points a duplicate post
+    to the stored file instead of keeping a second copy
+    """
+
+    def __init__(self, app=None, batch_size=100, max_authors=256):
+        self.batch_size = batch_size
+        self.max_authors = max_authors
+        # author ID -> (BK-tree, last photo_hash ID in it)
+        self._trees = OrderedDict()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of starting the hasher with the first request
+        :param app: Flask app
+        """
+        if app.config.get('PHOTO_HASH_INTERVAL'):
+            app.before_request(self._start)
+
+    def notify(self):
+        """The function of waking the thread up after a post is published"""
+        self._wake.set()
+
+    def run_once(self):
+        """
+        The function of hashing the photos of new posts
+        :return: number of processed posts
+        """
+        posts = db.session.execute(
+            sa.select(Post.id, Post.user_id, Post.photo_url)
+            .outerjoin(PhotoHash, PhotoHash.post_id == Post.id)
+            .where(PhotoHash.id.is_(None), Post.photo_url.is_not(None),
+                   Post.photo_url != '')
+            .order_by(Post.id).limit(self.batch_size)).all()
+        for post in posts:
+            copy = self.process(post.id, post.user_id, post.photo_url)
+            db.session.commit()
+            # the file is removed only when the post no longer refers to it
+            if copy is not None:
+                try:
+                    os.remove(copy)
+                except FileNotFoundError:
+                    pass
+        return len(posts)
+
+    def process(self, post_id, user_id, url):
+        """
+        The function of hashing one photo and linking it to an earlier copy
+        :param post_id: post ID
+        :param user_id: author ID
+        :param url: photo_url of the post
+        :return: path of the copy to remove or None
+        """
+        path = self.path(url)
+        value = None
+        if url.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS:
+            try:
+                value = to_signed(dhash(path))
+            except (OSError, ValueError, Image.DecompressionBombError):
+                current_app.logger.warning('Cannot hash photo %s', url)
+        original = None
+        if value is not None:
+            matches = self.tree(user_id).search(
+                value, current_app.config['PHOTO_DUPLICATE_DISTANCE'])
+            original = next((id for _, id in matches if id != post_id), None)
+        # two processes may pick the same post, the second insert is skipped
+        inserted = db.session.execute(insert_or_ignore(PhotoHash.__table__).values(
+            post_id=post_id, user_id=user_id, hash=value,
+            duplicate_of=original)).rowcount
+        if original is not None and inserted:
+            return self.link(post_id, user_id, url, original)
+        return None
+
+    def link(self, post_id, user_id, url, original_id):
+        """
+        The function of pointing a duplicate post to the stored photo
+        :return: path of the new copy if nothing else refers to it
+        """
+        original_url = db.session.scalar(
+            sa.select(Post.photo_url).where(Post.id == original_id))
+        current_app.logger.info('Photo of post %d repeats post %d',
+                                post_id, original_id)
+        # the original could be archived or be the same file
+        if not original_url or original_url == url:
+            return None
+        db.session.execute(sa.update(Post).where(Post.id == post_id)
+                           .values(photo_url=original_url))
+        exporter.mark([user_id])
+        shared = db.session.scalar(sa.select(Post.id).where(
+            Post.photo_url == url, Post.id != post_id).limit(1))
+        return self.path(url) if shared is None else None
+
+    def tree(self, user_id):
+        """
+        The function of getting the BK-tree of the author's photos.
+        The tree is kept between runs and only the rows added
+        since the last call, also by other processes, are read
+        :param user_id: author ID
+        :return: BKTree
+        """
+        tree, last_id = self._trees.pop(user_id, (BKTree(), 0))
+        rows = db.session.execute(
+            sa.select(PhotoHash.id, PhotoHash.post_id, PhotoHash.hash,
+                      PhotoHash.duplicate_of)
+            .where(PhotoHash.user_id == user_id, PhotoHash.id > last_id)
+            .order_by(PhotoHash.id)).all()
+        for row in rows:
+            # a duplicate is already in the tree as its original
+            if row.hash is not None and row.duplicate_of is None:
+                tree.add(row.hash, row.post_id)
+            last_id = row.id
+        self._trees[user_id] = (tree, last_id)
+        if len(self._trees) > self.max_authors:
+            self._trees.popitem(last=False)
+        return tree
+
+    @staticmethod
+    def path(url):
+        return os.path.join(current_app.config['UPLOAD_FOLDER'],
+                            os.path.basename(url))
+
+    def _start(self):
+        # the thread is started after fork, in the process that serves requests
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run, args=(app,), daemon=True,
+                         name='photo-hasher').start()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(app.config['PHOTO_HASH_INTERVAL'])
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    while self.run_once() == self.batch_size:
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Photo hashing failed')
+
+
+hasher = PhotoHasher()
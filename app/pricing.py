@@ -0,0 +1,104 @@
+import re
+import statistics
+from itertools import groupby
+
+# Currency aliases typed by users in the free-form price field
+CURRENCIES = {
+    '₽': 'RUB', 'руб': 'RUB', 'р': 'RUB', 'rub': 'RUB', 'rur': 'RUB',
+    '$': 'USD', 'usd': 'USD', 'долл': 'USD',
+    '€': 'EUR', 'eur': 'EUR', 'евро': 'EUR',
+    '£': 'GBP', 'gbp': 'GBP',
+    '₸': 'KZT', 'тенге': 'KZT', 'kzt': 'KZT',
+    '₺': 'TRY', 'try': 'TRY', 'лир': 'TRY',
+    '¥': 'CNY', 'cny': 'CNY', 'юан': 'CNY',
+}
+DEFAULT_CURRENCY = 'RUB'
+
+# Number multipliers: "15к", "1.5k", "2 млн"
+MULTIPLIERS = {'k': 1_000, 'к': 1_000, 'тыс': 1_000, 'm': 1_000_000,
+               'млн': 1_000_000}
+
+_NUMBER = re.compile(
+    r'(\d+(?:[ \u00a0\u202f.,]\d{3}(?!\d))*(?:[.,]\d+)?)(?!\d)'
+    r'(?:\s*(k|к|тыс[^\W\d_]*|m|млн[^\W\d_]*)(?![^\W\d_]))?',
+    re.IGNORECASE)
+_WORD = re.compile(r'[^\W\d_]+|[₽$€£₸₺¥]')
+
+
+def parse_price(text):
+    """
+    The function of parsing a free-form price.
+    Takes the first number in the text, thousands separators
+    and a decimal comma are allowed, a dot or a comma followed
+    by exactly three digits is read as a thousands separator
+    :param text: price as typed by the user ("1 500 руб", "$200", "15к")
+    :return: (amount: float, currency: str) or (None, None)
+    """
+    if not text:
+        return None, None
+    match = _NUMBER.search(text)
+    if match is None:
+        return None, None
+    parts = re.split(r'[.,]', re.sub(r'[ \u00a0\u202f]', '', match.group(1)))
+    fraction = parts.pop() if len(parts) > 1 and len(parts[-1]) != 3 else '0'
+    amount = float(''.join(parts) + '.' + fraction)
+    if match.group(2):
+        suffix = match.group(2).lower()
+        amount *= next(v for k, v in MULTIPLIERS.items() if suffix.startswith(k))
+
+    currency = DEFAULT_CURRENCY
+    for word in _WORD.findall(text.lower()):
+        code = next((code for alias, code in CURRENCIES.items()
+                     if word == alias or len(alias) > 1 and word.startswith(alias)),
+                    None)
+        if code:
+            currency = code
+            break
+    return round(amount, 2), currency
+
+
+def summarize(amounts):
+    """
+    The function of calculating the distribution of prices
+    :param amounts: sorted list of amounts
+    :return: dict with count, min, max, mean, median and percentiles
+    """
+    if len(amounts) > 1:
+        # cut points at 5%, 10%, ..., 95%
+        cuts = statistics.quantiles(amounts, n=20, method='inclusive')
+        p10, p25, p75, p90 = cuts[1], cuts[4], cuts[14], cuts[17]
+    else:
+        p10 = p25 = p75 = p90 = amounts[0]
+    return {
+        'count': len(amounts),
+        'min': amounts[0],
+        'max': amounts[-1],
+        'mean': round(statistics.fmean(amounts), 2),
+        'median': statistics.median(amounts),
+        'p10': p10, 'p25': p25, 'p75': p75, 'p90': p90,
+    }
+
+
+def price_stats(rows):
+    """
+    The function of grouping price rows and summarizing each group.
+    Rows must be ordered by key, currency and amount, so each group
+    is a ready sorted column slice and no per-row sorting is needed
+    :param rows: iterable of (key, currency, amount)
+    :return: list of dicts
+    """
+    stats = []
+    for (key, currency), group in groupby(rows, key=lambda r: (r[0], r[1])):
+        amounts = [row[2] for row in group]
+        stats.append({'key': key, 'currency': currency, **summarize(amounts)})
+    return stats
+
+
+def split_places(places):
+    """
+    The function of splitting the places field into separate names
+    :param places: str ("Париж, Лион; Ницца")
+    :return: list of normalized names
+    """
+    return [p.strip().lower() for p in re.split(r'[,;\n]', places or '')
+            if p.strip()]
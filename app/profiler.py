@@ -0,0 +1,174 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import wraps
+from flask import g, request
+from app.admin import is_admin_request
+
+# Admin requests with this header are always profiled
+PROFILE_HEADER = 'X-Profile'
+
+
+def frame_name(code):
+    """
+    Name of a stack frame in the collapsed format
+    :param code: code object of the frame
+    :return: 'function (file:line)'
+    """
+    name = '{} ({}:{})'.format(getattr(code, 'co_qualname', code.co_name),
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+    # ';' separates the frames of a collapsed stack
+    return name.replace(';', ':')
+
+
+class StackSampler(object):
+    """
+    Sampling profiler of one thread: another thread looks at its stack
+    every interval and counts the stacks it sees.
+    The profiled code is not instrumented, so it runs at full speed
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.duration = 0
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='stack-sampler')
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        """
+        The function of stopping the sampling
+        :return: Counter of collapsed stacks
+        """
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = self._names.get(code)
+                if name is None:
+                    name = self._names[code] = frame_name(code)
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class Profiler(object):
+    """
+    Opt-in profiling of web requests and bot handlers.
+    A PROFILE_SAMPLE_RATE share of them, and every admin request
+    with the X-Profile header, is sampled, and the stacks are written
+    to PROFILE_DIR/<endpoint>/ in the collapsed format
+    read by flamegraph.pl and speedscope
+    """
+
+    def __init__(self, app=None):
+        self.rate = 0
+        self.interval = 0.005
+        self.directory = None
+        self.logger = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of reading the config and adding the request hooks
+        :param app: Flask app
+        """
+        self.rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+        self.interval = app.config.get('PROFILE_INTERVAL', 0.005)
+        self.directory = app.config.get('PROFILE_DIR')
+        self.logger = app.logger
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def start(self):
+        """
+        The function of starting the sampling of the current thread
+        :return: StackSampler
+        """
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        return sampler
+
+    def save(self, name, sampler):
+        """
+        The function of stopping a sampler and writing its stacks
+        :param name: endpoint or bot handler
+        :param sampler: StackSampler
+        :return: path of the file, None if there were no samples
+        """
+        stacks = sampler.stop()
+        if not stacks or not self.directory:
+            return None
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '{:%Y%m%dT%H%M%S%f}-{}.folded'.format(
+            datetime.now(timezone.utc), os.getpid()))
+        with open(path, 'w', encoding='utf-8') as file:
+            file.writelines('{} {}\n'.format(stack, count)
+                            for stack, count in stacks.items())
+        self.logger.info('Profile of %s: %d samples in %.0f ms',
+                         name, sum(stacks.values()), sampler.duration * 1000,
+                         extra={'profile': path})
+        return path
+
+    def handler(self, name=None):
+        """
+        Decorator of the bot handlers, samples the same share of the calls
+        :param name: file directory, 'bot.<handler name>' by default
+        """
+        def decorator(function):
+            directory = name or 'bot.{}'.format(function.__name__)
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if random.random() >= self.rate:
+                    return function(*args, **kwargs)
+                sampler = self.start()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.save(directory, sampler)
+            return wrapper
+        return decorator
+
+    def _before_request(self):
+        if random.random() < self.rate or \
+                (PROFILE_HEADER in request.headers and is_admin_request()):
+            g.profile_sampler = self.start()
+
+    def _after_request(self, response):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            path = self.save(request.endpoint or 'unknown', sampler)
+            if path and is_admin_request():
+                response.headers[PROFILE_HEADER] = \
+                    os.path.relpath(path, self.directory)
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request is skipped when the view raised
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            self.save(request.endpoint or 'unknown', sampler)
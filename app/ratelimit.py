@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from functools import wraps
+from math import ceil
+from time import time
+from flask import request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+
+def take_token(tokens, updated, capacity, rate, cost, now):
+    """
+    Token bucket step: refills the bucket for the elapsed time
+    and takes the cost from it if there are enough tokens
+    :param tokens: tokens left after the previous request
+    :param updated: time of the previous request
+    :param rate: tokens refilled per second
+    :return: (tokens left, seconds to wait or 0)
+    """
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    cost = min(cost, capacity)
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryStore(object):
+    """
+    Buckets of one process.
+    At most max_keys buckets are kept, the least recently used go first
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated), oldest first
+        self._buckets = OrderedDict()
+        self._throttled = Counter()
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        with self._lock:
+            results = [take_token(*self._buckets.get(key, (capacity, now)),
+                                  capacity, rate, cost, now)
+                       for key, capacity, rate, cost in buckets]
+            waits = [wait for _, wait in results]
+            if any(waits):
+                return waits
+            for (key, *_), (tokens, _) in zip(buckets, results):
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return waits
+
+    def incr(self, name):
+        with self._lock:
+            self._throttled[name] += 1
+
+    def counters(self):
+        with self._lock:
+            return dict(self._throttled)
+
+
+class SQLiteStore(object):
+    """
+    Buckets in a local SQLite file, shared by the forked
+    web workers and the bot
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections must not cross threads or forks
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                               'key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS throttled ('
+                               'name TEXT PRIMARY KEY, count INTEGER)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def take(self, buckets, now):
+        keys = [key for key, *_ in buckets]
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = dict((key, (tokens, updated)) for key, tokens, updated in
+                        connection.execute(
+                            'SELECT key, tokens, updated FROM bucket '
+                            'WHERE key IN ({})'.format(', '.join('?' * len(keys))),
+                            keys))
+            results = [take_token(*rows.get(key, (capacity, now)),
+                                  capacity, rate, cost, now)
+                       for key, capacity, rate, cost in buckets]
+            waits = [wait for _, wait in results]
+            if not any(waits):
+                connection.executemany(
+                    'INSERT OR REPLACE INTO bucket (key, tokens, updated) '
+                    'VALUES (?, ?, ?)',
+                    [(key, tokens, now) for key, (tokens, _) in zip(keys, results)])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return waits
+
+    def incr(self, name):
+        self._connection().execute(
+            'INSERT INTO throttled (name, count) VALUES (?, 1) '
+            'ON CONFLICT (name) DO UPDATE SET count = count + 1', (name,))
+
+    def counters(self):
+        return dict(self._connection().execute(
+            'SELECT name, count FROM throttled').fetchall())
+
+
+def request_keys():
+    """
+    Default bucket keys of a web request: client IP and user
+    :return: list of str
+    """
+    keys = ['ip:{}'.format(request.remote_addr)]
+    if current_user.is_authenticated:
+        keys.append('user:{}'.format(current_user.id))
+    return keys
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiting of the expensive endpoints and bot commands.
+    Limits are set per name in the RATELIMITS config:
+    name -> (bucket capacity, seconds to refill it completely)
+    """
+
+    def __init__(self, app=None):
+        self.limits = {}
+        self.store = MemoryStore()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of reading the limits and the storage from the config.
+        RATELIMIT_STORAGE: 'memory' or a path to the shared SQLite file
+        :param app: Flask app
+        """
+        self.limits = app.config.get('RATELIMITS', {})
+        storage = app.config.get('RATELIMIT_STORAGE', 'memory')
+        self.store = MemoryStore() if storage == 'memory' \
+            else SQLiteStore(storage)
+
+    def hit(self, name, keys, cost=1):
+        """
+        The function of taking tokens from the buckets of every key
+        :param name: limit name from RATELIMITS
+        :param keys: list of keys (IP, user, telegram id)
+        :param cost: tokens the request costs
+        :return: seconds to wait, 0 if the request is allowed
+        """
+        return self.hit_many({name: cost}, keys)
+
+    def hit_many(self, costs, keys):
+        """
+        The function of checking several limits of one request at once
+        :param costs: dict limit name -> tokens the request costs
+        :param keys: list of keys (IP, user, telegram id)
+        :return: seconds to wait, 0 if the request is allowed
+        """
+        names = [name for name in costs if name in self.limits]
+        buckets = []
+        for name in names:
+            capacity, period = self.limits[name]
+            buckets += [('{}:{}'.format(name, key), capacity,
+                         capacity / period, costs[name]) for key in keys]
+        if not buckets:
+            return 0
+        # tokens are taken only if every bucket of every limit allows
+        # the request, a denied request must not drain the other buckets
+        waits = self.store.take(buckets, time())
+        for i, name in enumerate(names):
+            if any(waits[i * len(keys):(i + 1) * len(keys)]):
+                self.store.incr(name)
+        return max(waits)
+
+    def limit(self, *names, keys=request_keys, cost=None, methods=('POST',)):
+        """
+        View decorator, answers 429 with Retry-After when a limit is reached.
+        Several limits of a view are checked together, the request
+        takes tokens from all of them or from none
+        :param names: limit names from RATELIMITS
+        :param keys: function returning the bucket keys of the request
+        :param cost: function returning the cost of the request,
+            or dict limit name -> function, the other limits cost 1
+        :param methods: HTTP methods that are limited
+        """
+        def request_costs():
+            if isinstance(cost, dict):
+                return {name: cost[name]() if name in cost else 1
+                        for name in names}
+            return {name: cost() if cost else 1 for name in names}
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method in methods:
+                    wait = self.hit_many(request_costs(), keys())
+                    if wait:
+                        raise TooManyRequests(retry_after=ceil(wait))
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def counters(self):
+        """
+        Throttled requests by limit name
+        :return: dict
+        """
+        return self.store.counters()
@@ -1,24 +1,42 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from math import ceil
 from urllib.parse import urlsplit
 from flask_login import login_user, logout_user, current_user, login_required
 import sqlalchemy as sa
-from app import app, db
+from app import db, user_cache, archive, limiter, geo
+from app.admin import admin_required
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, \
     EmptyForm, PostForm
-from app.models import User, Post
-from flask import render_template
+from app.models import User, Post, PostScore, ArchivedPost
+from app.pricing import DEFAULT_CURRENCY, price_stats, split_places
+from app.ratelimit import request_keys
+from app.export import exporter
+from app.photos import hasher
+from app.trending import refresher
+from flask import render_template, jsonify, abort
 import os
-from flask import Flask, flash, request, redirect, url_for
+from flask import Blueprint, current_app, flash, request, redirect, url_for
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
 
+bp = Blueprint('main', __name__)
 
-@app.before_request
+
+# How often the last visit is written, every request would be a commit
+LAST_SEEN_INTERVAL = timedelta(minutes=1)
+
+
+@bp.before_app_request
 def before_request():
     """The function of updating the last visit"""
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        now = datetime.utcnow()
+        last_seen = current_user.last_seen
+        if last_seen is None or now - last_seen.replace(tzinfo=None) > LAST_SEEN_INTERVAL:
+            id = current_user.id
+            current_user.last_seen = now
+            db.session.commit()
+            user_cache.invalidate(id)
 
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'mp4'}
@@ -30,15 +48,56 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+def price_filter(query, model=Post):
+    """
+    The function of filtering a post query by the price range
+    from the request arguments min_price, max_price and currency.
+    The range is always taken within one currency,
+    so the query uses the (price_currency, price_amount) index
+    :param query: select of Post
+    :param model: Post or ArchivedPost
+    :return: (query, dict of filter arguments for the pagination links)
+    """
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+    if min_price is None and max_price is None:
+        return query, {}
+    currency = request.args.get('currency', DEFAULT_CURRENCY).upper()
+    args = {'currency': currency}
+    query = query.where(model.price_currency == currency)
+    if min_price is not None:
+        query = query.where(model.price_amount >= min_price)
+        args['min_price'] = min_price
+    if max_price is not None:
+        query = query.where(model.price_amount <= max_price)
+        args['max_price'] = max_price
+    return query, args
+
+
+def upload_megabytes():
+    """Cost of a request for the 'upload' limit"""
+    return ceil((request.content_length or 0) / 2 ** 20)
+
+
+def login_keys():
+    """
+    Bucket keys of a login attempt, the account is limited per client:
+    a shared bucket of the name would let anyone lock its owner out
+    """
+    return request_keys() + ['name:{}:{}'.format(
+        request.remote_addr, request.form.get('username'))]
+
+
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@limiter.limit('publish', 'upload', cost={'upload': upload_megabytes})
 def index():
     def gen_url(file):
         if allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            path = url_for('uploads', name=filename)
+            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+            path = url_for('main.uploads', name=filename)
             return path
         else:
             flash(f'Пока разрешены файлы только: {ALLOWED_EXTENSIONS}')
@@ -52,52 +111,165 @@ def index():
         post = Post(head=form.title.data, body=form.post.data, price=form.price.data, places=form.places.data,
                     photo_url=f_u, video_url=v_u, author=current_user)
         db.session.add(post)
+        geo.index_post(post)
+        exporter.mark([current_user.id])
         db.session.commit()
+        if f_u:
+            hasher.notify()
         flash('Опубликовано')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('index', page=posts.next_num) \
+    query, price_args = price_filter(current_user.following_posts())
+    posts = db.paginate(query, page=page,
+                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    refresher.record_views(post.id for post in posts.items)
+    next_url = url_for('main.index', page=posts.next_num, **price_args) \
         if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) \
+    prev_url = url_for('main.index', page=posts.prev_num, **price_args) \
         if posts.has_prev else None
     return render_template('index.html', title='Home', form=form,
                            posts=posts.items, next_url=next_url,
                            prev_url=prev_url,
-                           folder=app.config["UPLOAD_FOLDER"])
+                           folder=current_app.config["UPLOAD_FOLDER"])
 
 
-@app.route('/uploads/<name>')
+@bp.route('/uploads/<name>')
 def uploads(name):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], name)
+    return send_from_directory(current_app.config["UPLOAD_FOLDER"], name)
 
 
-@app.route('/explore')
+@bp.route('/explore')
 @login_required
 def explore():
     """The function of the page of all posts"""
     page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
+    query, price_args = price_filter(
+        sa.select(Post).order_by(Post.timestamp.desc()))
     posts = db.paginate(query, page=page,
-                        per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('explore', page=posts.next_num) \
+                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    refresher.record_views(post.id for post in posts.items)
+    next_url = url_for('main.explore', page=posts.next_num, **price_args) \
         if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', page=posts.prev_num, **price_args) \
         if posts.has_prev else None
     return render_template('index.html', title='Лента', posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/stats/prices')
+@login_required
+def price_statistics():
+    """
+    Price distribution function.
+    Reads the (key, currency, amount) columns in one query
+    and summarizes every group with median and percentiles
+    :param by: request argument, 'place' or 'author'
+    :param currency: optional request argument
+    :return: json
+    """
+    by = request.args.get('by', 'place')
+    if by not in ('place', 'author'):
+        abort(400)
+    key = User.username if by == 'author' else Post.places
+    query = sa.select(key, Post.price_currency, Post.price_amount) \
+        .where(Post.price_amount.is_not(None))
+    if by == 'author':
+        query = query.join(Post.author)
+    currency = request.args.get('currency')
+    if currency:
+        query = query.where(Post.price_currency == currency.upper())
+    rows = db.session.execute(
+        query.order_by(key, Post.price_currency, Post.price_amount)
+        .execution_options(yield_per=1000))
+    if by == 'place':
+        # one post lists several places, so the groups are built after splitting
+        rows = sorted((place, currency, amount)
+                      for places, currency, amount in rows
+                      for place in split_places(places))
+    return jsonify({'by': by, 'stats': price_stats(rows)})
+
+
+@bp.route('/trending')
+@login_required
+def trending():
+    """
+    The function of the page of popular posts.
+    Reads the top of the materialized post_score table by its index
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    # one more row tells whether there is a next page,
+    # the whole table is not counted on every view
+    query = sa.select(Post).join(PostScore).order_by(PostScore.score.desc()) \
+        .limit(per_page + 1).offset((page - 1) * per_page)
+    posts = db.session.scalars(query).all()
+    has_next = len(posts) > per_page
+    posts = posts[:per_page]
+    refresher.record_views(post.id for post in posts)
+    next_url = url_for('main.trending', page=page + 1) if has_next else None
+    prev_url = url_for('main.trending', page=page - 1) if page > 1 else None
+    return render_template('index.html', title='В тренде', posts=posts,
+                           next_url=next_url, prev_url=prev_url)
+
+
+# Largest search radius of the nearby page, km
+MAX_NEARBY_RADIUS = 500
+
+
+@bp.route('/nearby')
+@login_required
+def nearby():
+    """
+    The function of the page of trips near a point.
+    The point is given by lat and lon or by the name of a place
+    :param radius_km: request argument, 50 by default
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    place = request.args.get('place', '').strip()
+    radius = min(request.args.get('radius_km', 50, type=float), MAX_NEARBY_RADIUS)
+    if place:
+        point = geo.geocode(place)
+        if point is None:
+            flash('Место не найдено')
+            return redirect(url_for('main.explore'))
+        lat, lon = point
+    if lat is None or lon is None or not -90 <= lat <= 90 or \
+            not -180 <= lon <= 180 or radius <= 0:
+        abort(400)
+    args = {'place': place} if place else {'lat': lat, 'lon': lon}
+    args['radius_km'] = radius
+    page = request.args.get('page', 1, type=int)
+    posts = db.paginate(geo.nearby(lat, lon, radius), page=page,
+                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    refresher.record_views(post.id for post in posts.items)
+    next_url = url_for('main.nearby', page=posts.next_num, **args) \
+        if posts.has_next else None
+    prev_url = url_for('main.nearby', page=posts.prev_num, **args) \
+        if posts.has_prev else None
+    return render_template('index.html', title='Рядом', posts=posts.items,
+                           next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/metrics/ratelimit')
+@admin_required
+def ratelimit_metrics():
+    """
+    The function of the throttled requests counters
+    :return: json
+    """
+    return jsonify(limiter.counters())
+
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     """
     Account register function
     :return: register or login pages
     """
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     form = RegistrationForm()
     if form.validate_on_submit():
@@ -106,18 +278,19 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash('Вы зарегистрированы')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='Регистрация', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('login', keys=login_keys)
 def login():
     """
     Account login function
     :return: index or login pages
     """
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     form = LoginForm()
     if form.validate_on_submit():
@@ -125,29 +298,29 @@ def login():
             sa.select(User).where(User.username == form.username.data))
         if not user:
             flash('Пройдите регистрацию')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         if not user.check_password(form.password.data):
             flash('Не верное имя или пароль')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
-            next_page = url_for('index')
+            next_page = url_for('main.index')
         return redirect(next_page)
     return render_template('login.html', title='Вход', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """
     Account logout function
     :return: index page
     """
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/user/<username>')
+@bp.route('/user/<username>')
 @login_required
 def user(username):
     """
@@ -155,22 +328,32 @@ def user(username):
     :param username: str
     :return: render profile and data
     """
-    user = db.first_or_404(sa.select(User).where(User.username == username))
+    user = User.cached_by_username(username)
+    if user is None:
+        abort(404)
     page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    query, price_args = price_filter(
+        user.posts.select().order_by(Post.timestamp.desc()))
+    archived, _ = price_filter(
+        sa.select(ArchivedPost).where(ArchivedPost.user_id == user.id)
+        .order_by(ArchivedPost.timestamp.desc()), ArchivedPost)
+    # old posts continue from the archive after the last hot page
+    posts = archive.paginate(query, archived, page=page,
+                             per_page=current_app.config['POSTS_PER_PAGE'],
+                             error_out=False)
+    refresher.record_views(post.id for post in posts.items)
+    next_url = url_for('main.user', username=user.username, page=posts.next_num,
+                       **price_args) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username, page=posts.prev_num,
+                       **price_args) if posts.has_prev else None
     form = EmptyForm()
+    is_following = user.id in current_user.following_ids([user])
     return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+                           next_url=next_url, prev_url=prev_url, form=form,
+                           is_following=is_following)
 
 
-@app.route('/edit_profile', methods=['GET', 'POST'])
+@bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     """
@@ -179,11 +362,14 @@ def edit_profile():
     """
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        id = current_user.id
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
+        exporter.mark([id])
         db.session.commit()
+        user_cache.invalidate(id)
         flash('Сохранено')
-        return redirect(url_for('edit_profile'))
+        return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -191,7 +377,7 @@ def edit_profile():
                            form=form)
 
 
-@app.route('/follow/<username>', methods=['POST'])
+@bp.route('/follow/<username>', methods=['POST'])
 @login_required
 def follow(username):
     """
@@ -201,23 +387,26 @@ def follow(username):
     """
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == username))
+        user = User.cached_by_username(username)
         if user is None:
             flash(f'User {username} not found.')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         if user == current_user:
             flash('Это вы')
-            return redirect(url_for('user', username=username))
-        current_user.follow(user)
+            return redirect(url_for('main.user', username=username))
+        changed = current_user.follow(user)
+        if changed:
+            exporter.mark([current_user.id, user.id])
         db.session.commit()
+        if changed:
+            refresher.mark_author(user.id)
         flash(f'Подписались на {username}')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
 
-@app.route('/unfollow/<username>', methods=['POST'])
+@bp.route('/unfollow/<username>', methods=['POST'])
 @login_required
 def unfollow(username):
     """
@@ -227,17 +416,66 @@ def unfollow(username):
     """
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == username))
+        user = User.cached_by_username(username)
         if user is None:
             flash(f'Пользователь {username} не найден.')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         if user == current_user:
             flash('Это вы')
-            return redirect(url_for('user', username=username))
-        current_user.unfollow(user)
+            return redirect(url_for('main.user', username=username))
+        changed = current_user.unfollow(user)
+        if changed:
+            exporter.mark([current_user.id, user.id])
         db.session.commit()
+        if changed:
+            refresher.mark_author(user.id)
         flash(f'Отписались от {username}.')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
+
+
+# The most usernames one bulk request may list
+BULK_FOLLOW_LIMIT = 1000
+
+
+@bp.route('/api/follow', methods=['POST'])
+@login_required
+def follow_bulk():
+    """
+    Bulk subscription function for onboarding and imports.
+    Takes JSON {"follow": [usernames], "unfollow": [usernames], "csrf_token": ...}
+    and applies it in one transaction
+    :return: json with the changed and unknown usernames
+    """
+    data = request.get_json(silent=True)
+    # the form reads the CSRF token from the JSON, it must be an object
+    if not isinstance(data, dict):
+        abort(400)
+    form = EmptyForm()
+    if not form.validate_on_submit():
+        abort(400)
+    to_follow = data.get('follow') or []
+    to_unfollow = data.get('unfollow') or []
+    if not all(isinstance(names, list) and
+               all(isinstance(name, str) for name in names)
+               for names in (to_follow, to_unfollow)):
+        abort(400)
+    names = set(to_follow) | set(to_unfollow)
+    if len(names) > BULK_FOLLOW_LIMIT:
+        abort(413)
+    ids = dict(db.session.execute(
+        sa.select(User.username, User.id).where(User.username.in_(names))).all())
+    followed = current_user.follow_ids(ids[name] for name in to_follow if name in ids)
+    unfollowed = current_user.unfollow_ids(ids[name] for name in to_unfollow if name in ids)
+    if followed or unfollowed:
+        exporter.mark([current_user.id] + followed + unfollowed)
+    db.session.commit()
+    for id in followed + unfollowed:
+        refresher.mark_author(id)
+    names_by_id = {id: name for name, id in ids.items()}
+    return jsonify({
+        'followed': [names_by_id[id] for id in followed],
+        'unfollowed': [names_by_id[id] for id in unfollowed],
+        'not_found': sorted(names - set(ids)),
+    })
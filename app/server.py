@@ -0,0 +1,139 @@
+import contextvars
+import os
+import signal
+import socket
+import sys
+import time
+from werkzeug.serving import make_server
+from app import logs
+
+# The listening socket is handed over to the new master on reload
+LISTEN_FD_ENV = 'TRAVEL_DIARY_LISTEN_FD'
+
+
+def listen(bind, backlog=128):
+    """
+    The function of opening the listening socket.
+    After a reload the socket inherited from the old master is reused,
+    so connections wait in the backlog instead of being refused
+    :param bind: 'host:port'
+    :return: socket
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        host, port = bind.rsplit(':', 1)
+        sock = socket.create_server((host, int(port)), backlog=backlog)
+    sock.set_inheritable(True)
+    # workers share the socket, the ones that lose the accept race must not block
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(app, sock):
+    """
+    Worker process loop.
+    Serves one request at a time and exits after SIGTERM
+    once the current request is finished
+    :param app: preloaded Flask app
+    :param sock: shared listening socket
+    """
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # connections opened by the master must not be shared between processes
+    with app.app_context():
+        from app import db
+        db.engine.dispose(close=False)
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, fd=sock.fileno())
+    server.timeout = 1
+
+    def loop():
+        while running:
+            server.handle_request()
+
+    # the fork inherits the app context of the "flask serve" command,
+    # the requests would share its g and the logged-in user.
+    # They run in an empty context and push their own app context
+    contextvars.Context().run(loop)
+    # os._exit skips atexit, the queued log records are written here
+    logs.stop()
+    os._exit(0)
+
+
+def serve(app, bind, workers, graceful_timeout=30):
+    """
+    Preforking server.
+    The app is loaded once in the master and the workers are forked from it.
+    SIGHUP - graceful reload: workers finish their requests
+    and the master re-executes itself with the new code.
+    SIGTERM, SIGINT - graceful stop
+    :param app: preloaded Flask app
+    :param bind: 'host:port'
+    :param workers: number of worker processes
+    :param graceful_timeout: seconds before unfinished workers are killed
+    """
+    sock = listen(bind)
+    children = set()
+    state = {'running': True, 'reload': False}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(app, sock)
+        children.add(pid)
+
+    def stop(signum, frame):
+        state['running'] = False
+
+    def reload(signum, frame):
+        state['running'] = False
+        state['reload'] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    app.logger.info('Listening on %s, master %d, %d workers',
+                    bind, os.getpid(), workers)
+    for _ in range(workers):
+        spawn()
+
+    while state['running']:
+        time.sleep(0.5)
+        for pid in list(children):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done and state['running']:
+                app.logger.warning('Worker %d exited with %d, restarting',
+                                   pid, status)
+                children.discard(pid)
+                spawn()
+
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + graceful_timeout
+    while children and time.monotonic() < deadline:
+        for pid in list(children):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                children.discard(pid)
+        time.sleep(0.1)
+    for pid in children:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    if state['reload']:
+        app.logger.info('Reloading master %d', os.getpid())
+        os.environ[LISTEN_FD_ENV] = str(sock.fileno())
+        logs.stop()
+        os.execv(sys.executable, sys.orig_argv)
+    sock.close()
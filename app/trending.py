@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.models import Post, PostScore, followers
+
+
+def trending_score(views, followers, timestamp, half_life, follower_weight):
+    """
+    The function of calculating the trending score.
+    Ranking by (1 + engagement) * 2 ** (-age / half_life) is the same
+    as ranking by its logarithm without the common "now" term,
+    so the stored score never has to be recomputed as posts get older
+    :param views: post impressions
+    :param followers: author followers count
+    :param timestamp: post creation time
+    :return: float
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    engagement = views + follower_weight * followers
+    return math.log1p(engagement) + \
+        timestamp.timestamp() / half_life * math.log(2)
+
+
+class TrendingRefresher(object):
+    """
+    Background maintenance of the post_score table.
+    Feed requests only buffer impressions and changed authors in memory,
+    a thread in every process flushes them and rescores the affected posts
+    """
+
+    def __init__(self, app=None, batch_size=500):
+        self.batch_size = batch_size
+        self._views = Counter()
+        self._authors = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        The function of starting the refresher with the first request
+        :param app: Flask app
+        """
+        if app.config.get('TRENDING_REFRESH_INTERVAL'):
+            app.before_request(self._start)
+
+    def record_views(self, post_ids):
+        """
+        The function of counting impressions of the shown posts
+        :param post_ids: iterable of post IDs
+        """
+        with self._lock:
+            self._views.update(post_ids)
+
+    def mark_author(self, user_id):
+        """
+        The function of marking an author whose followers have changed
+        :param user_id: author ID
+        """
+        with self._lock:
+            self._authors.add(user_id)
+
+    def refresh(self):
+        """
+        The function of one incremental pass:
+        flushes the buffered impressions and rescores the posts
+        that were shown, the posts of changed authors and new posts
+        :return: number of rescored posts
+        """
+        with self._lock:
+            views, self._views = self._views, Counter()
+            authors, self._authors = self._authors, set()
+        try:
+            return self._refresh(views, authors)
+        except Exception:
+            # e.g. "database is locked": the next pass retries the same data
+            with self._lock:
+                self._views.update(views)
+                self._authors.update(authors)
+            raise
+
+    def _refresh(self, views, authors):
+        if views:
+            # increments, so the workers flushing their own buffers don't clash
+            post_table = Post.__table__
+            db.session.execute(
+                sa.update(post_table)
+                .where(post_table.c.id == sa.bindparam('post_id'))
+                .values(views=post_table.c.views + sa.bindparam('count')),
+                [{'post_id': id, 'count': count} for id, count in views.items()])
+        ids = set(views)
+        if authors:
+            ids.update(db.session.scalars(
+                sa.select(Post.id).where(Post.user_id.in_(authors))))
+        ids.update(db.session.scalars(
+            sa.select(Post.id).outerjoin(PostScore)
+            .where(PostScore.post_id.is_(None)).limit(self.batch_size)))
+        ids = list(ids)
+        for i in range(0, len(ids), self.batch_size):
+            self.rescore(ids[i:i + self.batch_size])
+        db.session.commit()
+        return len(ids)
+
+    def rebuild(self):
+        """
+        The function of recomputing the scores of all posts
+        :return: number of rescored posts
+        """
+        count = 0
+        last_id = 0
+        while True:
+            ids = db.session.scalars(
+                sa.select(Post.id).where(Post.id > last_id)
+                .order_by(Post.id).limit(self.batch_size)).all()
+            if not ids:
+                break
+            self.rescore(ids)
+            db.session.commit()
+            count += len(ids)
+            last_id = ids[-1]
+        return count
+
+    def rescore(self, ids):
+        """
+        The function of replacing the scores of the given posts
+        :param ids: list of post IDs
+        """
+        posts = db.session.execute(
+            sa.select(Post.id, Post.user_id, Post.views, Post.timestamp)
+            .where(Post.id.in_(ids))).all()
+        authors = {post.user_id for post in posts}
+        follower_counts = dict(db.session.execute(
+            sa.select(followers.c.followed_id, sa.func.count())
+            .where(followers.c.followed_id.in_(authors))
+            .group_by(followers.c.followed_id)).all())
+
+        config = current_app.config
+        now = datetime.now(timezone.utc)
+        db.session.execute(sa.delete(PostScore).where(PostScore.post_id.in_(ids)))
+        if posts:
+            db.session.execute(sa.insert(PostScore), [{
+                'post_id': post.id,
+                'score': trending_score(
+                    post.views, follower_counts.get(post.user_id, 0),
+                    post.timestamp, config['TRENDING_HALF_LIFE'],
+                    config['TRENDING_FOLLOWER_WEIGHT']),
+                'updated_at': now,
+            } for post in posts])
+
+    def _start(self):
+        # the thread is started after fork, in the process that serves requests
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run, args=(app,), daemon=True,
+                         name='trending-refresher').start()
+
+    def _run(self, app):
+        while True:
+            time.sleep(app.config['TRENDING_REFRESH_INTERVAL'])
+            with app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Trending refresh failed')
+
+
+refresher = TrendingRefresher()
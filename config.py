@@ -1,12 +1,10 @@
-from dotenv import load_dotenv, find_dotenv
+from dotenv import load_dotenv
 import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-if not find_dotenv():
-    exit("Environment variables are not loaded because there is no .env file")
-else:
-    load_dotenv()
+# .env is optional, without it the defaults below are used
+load_dotenv(os.path.join(basedir, '.env'))
 
 
 class Config(object):
@@ -17,8 +15,82 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL') or \
                               'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Old posts are moved to a separate database by "flask archive run"
+    SQLALCHEMY_BINDS = {
+        'archive': os.getenv('ARCHIVE_DATABASE_URL') or
+                   'sqlite:///' + os.path.join(basedir, 'archive.db'),
+    }
+    ARCHIVE_AFTER_DAYS = 365
 
     # The number of displayed items in the /index, /explore
     POSTS_PER_PAGE = 3
 
+    # Per-process cache of users for load_user and profile lookups
+    IDENTITY_CACHE_SIZE = 1024
+    IDENTITY_CACHE_TTL = 60
+
+    # Trending: the score halves every TRENDING_HALF_LIFE seconds,
+    # engagement = views + TRENDING_FOLLOWER_WEIGHT * author followers
+    TRENDING_HALF_LIFE = 6 * 60 * 60
+    TRENDING_FOLLOWER_WEIGHT = 0.5
+    # Seconds between background refreshes, 0 - only "flask trending refresh"
+    TRENDING_REFRESH_INTERVAL = 30
+
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
+    MAX_CONTENT_LENGTH = 64 * 1024 * 1024
+    # Photos of one author whose perceptual hashes differ in at most
+    # this many of 64 bits are stored once
+    PHOTO_DUPLICATE_DISTANCE = 6
+    # Seconds between background hashing passes, publishing wakes it earlier,
+    # 0 - only "flask photos hash"
+    PHOTO_HASH_INTERVAL = 60
+
+    # Static export of the diaries for a static file server or CDN:
+    # EXPORT_DIR/<username>/index.html, page-N.html, page-N.json, profile.json
+    EXPORT_DIR = os.getenv('EXPORT_DIR') or os.path.join(basedir, 'export')
+    EXPORT_POSTS_PER_PAGE = 20
+    # Prefix of the media links, e.g. the CDN host serving UPLOAD_FOLDER at /uploads
+    EXPORT_MEDIA_URL = os.getenv('EXPORT_MEDIA_URL') or ''
+    # Seconds between background export passes, a change wakes it earlier,
+    # 0 - only "flask export run"
+    EXPORT_INTERVAL = 30
+
+    # Token buckets: name -> (capacity, seconds to refill it completely)
+    RATELIMITS = {
+        'login': (5, 60),
+        'publish': (10, 60 * 60),
+        'upload': (256, 60 * 60),  # megabytes
+        'bot_reset': (3, 10 * 60),
+        'bot_password': (5, 5 * 60),
+        'bot_connect': (5, 5 * 60),
+    }
+    # 'memory' - per process, or a path to a SQLite file
+    # shared by the server workers and the bot
+    RATELIMIT_STORAGE = os.getenv('RATELIMIT_STORAGE') or 'memory'
+
+    # Service pages are opened with the X-Admin-Token header
+    ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+    # Sampling profiler: this share of the requests and bot handlers,
+    # and admin requests with the X-Profile header, are written
+    # to PROFILE_DIR/<endpoint>/ as collapsed stacks (flamegraph.pl, speedscope)
+    PROFILE_DIR = os.path.join(basedir, 'profiles')
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE') or 0)
+    # Seconds between the stack samples
+    PROFILE_INTERVAL = 0.005
+
+    # Logs: JSON lines written by a background thread,
+    # the file is rotated by size or age, DEBUG records are sampled
+    LOG_DIR = os.path.join(basedir, 'logs')
+    LOG_LEVEL = os.getenv('LOG_LEVEL') or 'INFO'
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_ROTATE_SECONDS = 24 * 60 * 60
+    LOG_BACKUP_COUNT = 10
+    LOG_DEBUG_SAMPLE_RATE = 0.1
+    LOG_QUEUE_SIZE = 10000
+
+    # "flask serve": address and the number of forked worker processes
+    SERVER_BIND = os.getenv('SERVER_BIND') or '127.0.0.1:8000'
+    SERVER_WORKERS = int(os.getenv('SERVER_WORKERS') or 2)
+    # Seconds given to workers to finish the current request on stop/reload
+    SERVER_GRACEFUL_TIMEOUT = 30
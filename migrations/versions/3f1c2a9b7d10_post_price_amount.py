@@ -0,0 +1,54 @@
+"""post price amount
+
+Revision ID: 3f1c2a9b7d10
+Revises: 
+Create Date: 2026-10-19 10:12:41.532117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.pricing import parse_price
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+post = sa.table('post',
+                sa.column('id', sa.Integer),
+                sa.column('price', sa.String),
+                sa.column('price_amount', sa.Float),
+                sa.column('price_currency', sa.String))
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('price_amount', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('price_currency', sa.String(length=3), nullable=True))
+        batch_op.create_index('ix_post_price_currency_amount', ['price_currency', 'price_amount'], unique=False)
+
+    # backfill the numeric price of the existing posts in batches
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(post.c.id, post.c.price)
+            .where(post.c.id > last_id).order_by(post.c.id).limit(1000)).all()
+        if not rows:
+            break
+        connection.execute(
+            post.update().where(post.c.id == sa.bindparam('post_id'))
+            .values(price_amount=sa.bindparam('amount'),
+                    price_currency=sa.bindparam('currency')),
+            [dict(zip(('amount', 'currency'), parse_price(price)), post_id=id)
+             for id, price in rows])
+        last_id = rows[-1].id
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_price_currency_amount')
+        batch_op.drop_column('price_currency')
+        batch_op.drop_column('price_amount')
@@ -0,0 +1,44 @@
+"""post place
+
+Revision ID: 5d9a3c7e2b41
+Revises: 8b2e4d6f1a37
+Create Date: 2026-10-19 15:21:47.402518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d9a3c7e2b41'
+down_revision = '8b2e4d6f1a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_place',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('lat', sa.Float(), nullable=False),
+    sa.Column('lon', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('post_place', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_post_place_post_id'), ['post_id'], unique=False)
+
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE post_place_rtree '
+                   'USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE post_place_rtree')
+
+    with op.batch_alter_table('post_place', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_post_place_post_id'))
+
+    op.drop_table('post_place')
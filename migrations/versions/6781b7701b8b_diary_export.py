@@ -0,0 +1,31 @@
+"""diary export
+
+Revision ID: 6781b7701b8b
+Revises: 79ed633c62c0
+Create Date: 2026-10-19 13:45:19.602389
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6781b7701b8b'
+down_revision = '79ed633c62c0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('diary_export',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('username', sa.String(length=64), nullable=False),
+    sa.Column('exported_at', sa.DateTime(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('diary_export')
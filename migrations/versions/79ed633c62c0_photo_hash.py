@@ -0,0 +1,39 @@
+"""photo hash
+
+Revision ID: 79ed633c62c0
+Revises: 5d9a3c7e2b41
+Create Date: 2026-10-19 13:42:44.107269
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '79ed633c62c0'
+down_revision = '5d9a3c7e2b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('photo_hash',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('hash', sa.BigInteger(), nullable=True),
+    sa.Column('duplicate_of', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('post_id')
+    )
+    with op.batch_alter_table('photo_hash', schema=None) as batch_op:
+        batch_op.create_index('ix_photo_hash_user_id_id', ['user_id', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('photo_hash', schema=None) as batch_op:
+        batch_op.drop_index('ix_photo_hash_user_id_id')
+
+    op.drop_table('photo_hash')
@@ -0,0 +1,41 @@
+"""post score
+
+Revision ID: 8b2e4d6f1a37
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-19 12:40:03.118265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f1a37'
+down_revision = '3f1c2a9b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_score',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.PrimaryKeyConstraint('post_id')
+    )
+    with op.batch_alter_table('post_score', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_post_score_score'), ['score'], unique=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('views', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('views')
+
+    with op.batch_alter_table('post_score', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_post_score_score'))
+
+    op.drop_table('post_score')
@@ -0,0 +1,33 @@
+"""post autoincrement
+
+Revision ID: a4c8e1f05d92
+Revises: 6781b7701b8b
+Create Date: 2026-10-19 14:12:37.418205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c8e1f05d92'
+down_revision = '6781b7701b8b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # only SQLite reuses the IDs, the table is rebuilt with AUTOINCREMENT
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('post', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('post', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': False}) as batch_op:
+        pass
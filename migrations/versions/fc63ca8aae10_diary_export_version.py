@@ -0,0 +1,44 @@
+"""diary export version
+
+Revision ID: fc63ca8aae10
+Revises: a4c8e1f05d92
+Create Date: 2026-10-19 14:08:07.730932
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fc63ca8aae10'
+down_revision = 'a4c8e1f05d92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('diary_export', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('exported_version', sa.Integer(), nullable=True))
+        batch_op.alter_column('exported_at',
+               existing_type=sa.DATETIME(),
+               nullable=True)
+    # the diaries changed after their export stay marked
+    op.execute("UPDATE diary_export SET exported_version = 0 "
+               "WHERE changed_at IS NULL OR changed_at <= exported_at")
+    with op.batch_alter_table('diary_export', schema=None) as batch_op:
+        batch_op.drop_column('changed_at')
+
+
+def downgrade():
+    with op.batch_alter_table('diary_export', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('changed_at', sa.DATETIME(), nullable=True))
+    op.execute("DELETE FROM diary_export WHERE exported_at IS NULL")
+    op.execute("UPDATE diary_export SET changed_at = CURRENT_TIMESTAMP "
+               "WHERE exported_version IS NULL OR version > exported_version")
+    with op.batch_alter_table('diary_export', schema=None) as batch_op:
+        batch_op.alter_column('exported_at',
+               existing_type=sa.DATETIME(),
+               nullable=False)
+        batch_op.drop_column('exported_version')
+        batch_op.drop_column('version')
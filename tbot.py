@@ -1,4 +1,7 @@
 import os
+import sys
+from functools import wraps
+from math import ceil
 from dotenv import load_dotenv, find_dotenv
 from loguru import logger
 from telebot import TeleBot
@@ -9,19 +12,24 @@ from telebot.handler_backends import State, StatesGroup
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlalchemy as sa
 from sqlalchemy.exc import IntegrityError
-from app import app, db
+from app import create_app, db, limiter, logs, profiler
+from app.export import exporter
 from app.models import User
 
-logger.add('logs/bot.log', format="{time} {level}    {message}", level="INFO")
-logger.add('logs/bot.log', format="{time} {level}    {message}", level="ERROR")
-logger.add('logs/bot.log', format="{time} {level}    {message}", level="DEBUG")
-
 if not find_dotenv():
     exit("Environment variables are not loaded because there is no .env file")
 else:
     load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# The bot works with the models only, the web pages are not loaded
+app = create_app(web=False)
+
+# One non-blocking sink shared with the web app pipeline, see app/logs.py
+logger.remove()
+logger.add(sys.stderr, level="INFO")
+# a callable format keeps loguru from appending the traceback, it goes to "exc"
+logger.add(logs.get_handler(app.config, 'bot.log'), format=lambda record: "{message}", level="DEBUG")
 DEFAULT_COMMANDS = (
     ('start', "Запустить бота"),
     ('help', "Вывести список команд"),
@@ -46,6 +54,26 @@ def set_default_commands(bot) -> None:
     )
 
 
+def rate_limited(name: str):
+    """
+    Handler decorator: token bucket per telegram id,
+    limits are set in RATELIMITS of the config
+    :param name: limit name
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(message: Message) -> None:
+            wait = limiter.hit(name, ['tg:{}'.format(message.from_user.id)])
+            if wait:
+                logger.info(f"{name} throttled for {message.from_user.id}")
+                bot.send_message(message.from_user.id,
+                                 f'Слишком много попыток, повторите через {ceil(wait)} сек.')
+                return
+            handler(message)
+        return wrapper
+    return decorator
+
+
 def menu_buttons() -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardMarkup()
     keyboard.add((KeyboardButton("/reset")))
@@ -65,6 +93,7 @@ def menu_buttons() -> ReplyKeyboardMarkup:
 
 
 @bot.message_handler(commands=["help"])
+@profiler.handler()
 def bot_help(message: Message) -> None:
     """
     The handler of the <help> command.
@@ -79,6 +108,7 @@ def bot_help(message: Message) -> None:
 
 
 @bot.message_handler(commands=['start'])
+@profiler.handler()
 def bot_start(message: Message) -> None:
     """
     The handler of the <start> command.
@@ -95,6 +125,8 @@ def bot_start(message: Message) -> None:
 
 
 @bot.message_handler(commands=["reset"])
+@profiler.handler()
+@rate_limited('bot_reset')
 def start_script(message: Message) -> None:
     logger.debug("/reset")
     with app.app_context():
@@ -114,6 +146,8 @@ def start_script(message: Message) -> None:
 
 
 @bot.message_handler(state=UserInfoState.wait_password)
+@profiler.handler()
+@rate_limited('bot_password')
 def wait_password(message: Message) -> None:
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         data["password_hash"] = generate_password_hash(message.text)
@@ -124,6 +158,8 @@ def wait_password(message: Message) -> None:
 
 
 @bot.message_handler(state=UserInfoState.wait_password2)
+@profiler.handler()
+@rate_limited('bot_password')
 def wait_password2(message: Message) -> None:
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         if check_password_hash(data['password_hash'], message.text):
@@ -142,6 +178,8 @@ def wait_password2(message: Message) -> None:
 
 
 @bot.message_handler(commands=["connect"])
+@profiler.handler()
+@rate_limited('bot_connect')
 def connect(message: Message) -> None:
     logger.debug("/connect")
     bot.send_message(message.from_user.id,
@@ -152,6 +190,7 @@ def connect(message: Message) -> None:
 
 
 @bot.message_handler(state=UserInfoState.wait_username)
+@profiler.handler()
 def wait_username(message: Message) -> None:
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         data["username"] = message.text.strip()
@@ -170,6 +209,8 @@ def wait_username(message: Message) -> None:
 
 
 @bot.message_handler(state=UserInfoState.wait_pass_connect)
+@profiler.handler()
+@rate_limited('bot_password')
 def wait_pass_connect(message: Message) -> None:
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         with app.app_context():
@@ -180,6 +221,7 @@ def wait_pass_connect(message: Message) -> None:
                     try:
                         user.telegram = message.from_user.username
                         db.session.add(user)
+                        exporter.mark([user.id])
                         db.session.commit()
                         bot.send_message(message.from_user.id,
                                          f'Вы подключены\n\nВ профиль добавлена ссылка на этот акаунт.')
@@ -204,10 +246,6 @@ def wait_pass_connect(message: Message) -> None:
 
 
 if __name__ == '__main__':
-    with open("logs/bot.log", 'w') as info_log:
-        """Clearing bot logs"""
-        print('Bot logs cleared')
-
     bot.add_custom_filter(StateFilter(bot))
     set_default_commands(bot)
     bot.infinity_polling()